@@ -1,27 +1,20 @@
 import numpy as np
 
+# ids of the aruco markers on the map, in the order their corners appear in obj
+map_marker_ids = [0, 1, 2, 3]
+
+# size of the aruco markers and position of their top-left corners in cm
+marker_size_cm = 2
+marker_positions = np.array([[0, 0],  # Marker 0
+                             [17, 0],  # Marker 1
+                             [0, 24],  # Marker 2
+                             [17, 24]])  # Marker 3
+# offsets of the four corners of a marker, in the order returned by detectMarkers
+corner_offsets = np.array([[0, 0], [1, 0], [1, 1], [0, 1]]) * marker_size_cm
+
 # position of the aruco markers corners in cm
-obj = np.empty((16, 3), dtype=np.float32)
-# Marker 0
-obj[0, :] = [0, 0, 0]
-obj[1, :] = [2, 0, 0]
-obj[2, :] = [2, 2, 0]
-obj[3, :] = [0, 2, 0]
-# Marker 1
-obj[4, :] = [17, 0, 0]
-obj[5, :] = [17 + 2, 0, 0]
-obj[6, :] = [17 + 2, 2, 0]
-obj[7, :] = [17, 2, 0]
-# Marker 2
-obj[8, :] = [0, 24, 0]
-obj[9, :] = [2, 24, 0]
-obj[10, :] = [2, 26, 0]
-obj[11, :] = [0, 26, 0]
-# Marker 3
-obj[12, :] = [17, 24, 0]
-obj[13, :] = [17 + 2, 24, 0]
-obj[14, :] = [17 + 2, 26, 0]
-obj[15, :] = [17, 26, 0]
+obj = np.zeros((len(marker_positions) * 4, 3), dtype=np.float32)
+obj[:, :2] = (marker_positions[:, None, :] + corner_offsets[None, :, :]).reshape(-1, 2)
 
 map_dict = {1: "Broadway",
             2: "Pacific Avenue",
@@ -5,44 +5,136 @@ import time
 import numpy as np
 import pickle
 import argparse
+import threading
 import pyglet.media
-from scipy import stats
 from map_parameters import *
-
+try:
+    from numba import njit
+    have_numba = True
+except ImportError:
+    have_numba = False
+    # numba is optional; without it the jitted helpers below run as plain Python
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+
+# Aruco dictionaries selectable by name
+aruco_dict_ids = {name: getattr(cv.aruco, name) for name in
+                  ["DICT_4X4_50", "DICT_4X4_100", "DICT_4X4_250", "DICT_4X4_1000",
+                   "DICT_5X5_50", "DICT_5X5_100", "DICT_5X5_250", "DICT_5X5_1000",
+                   "DICT_6X6_50", "DICT_6X6_100", "DICT_6X6_250", "DICT_6X6_1000",
+                   "DICT_7X7_50", "DICT_7X7_100", "DICT_7X7_250", "DICT_7X7_1000",
+                   "DICT_ARUCO_ORIGINAL"]}
+
+
+# Returns the OpenCV id of the aruco dictionary with the given name
+def get_aruco_dict_id_from_string(s):
+    try:
+        return aruco_dict_ids[s]
+    except KeyError:
+        raise KeyError(f"Unknown aruco dictionary '{s}', expected one of: {', '.join(aruco_dict_ids)}") from None
+
+
+# Reads frames from the camera on a background thread, keeping only the most recent one
+class FrameGrabber:
+    def __init__(self, cap):
+        self.cap = cap
+        self.cond = threading.Condition()
+        self.frame = None
+        self.ret = True
+        self.frame_count = 0
+        self.read_count = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        buf = None
+        try:
+            while self.running:
+                ret, buf = self.cap.read(buf)
+                with self.cond:
+                    self.ret = ret
+                    if ret:
+                        # swap buffers so the next read does not overwrite the published frame
+                        self.frame, buf = buf, self.frame
+                        self.frame_count += 1
+                    self.cond.notify()
+                if not ret:
+                    break
+        finally:
+            # Wake up read() however the thread ends, e.g. cap.read raising when the camera is unplugged
+            with self.cond:
+                self.ret = False
+                self.cond.notify()
+
+    # Copies the newest frame that has not been returned yet into out, waiting for one if needed
+    def read(self, out=None):
+        with self.cond:
+            self.cond.wait_for(lambda: self.frame_count > self.read_count or not self.ret)
+            if self.frame_count == self.read_count:
+                return False, out
+            self.read_count = self.frame_count
+            if out is None or out.shape != self.frame.shape:
+                out = self.frame.copy()
+            else:
+                np.copyto(out, self.frame)
+            return True, out
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
 
 
 # Function to sort corners by id based on how they are arranged
-def sort_corners_by_id(corners, id, scene):
-    use_index = np.zeros(16, dtype=bool)
-    for i in range(len(corners)):
-        corner_num = ids[i, 0]
-        if corner_num < 4:
-            for j in range(4):
-                use_index[4 * corner_num + j] = True
-                scene[4 * corner_num + j, :] = corners[i][0][j]
+def sort_corners_by_id(corners, ids, scene, id_to_slot, use_index):
+    use_index.fill(False)
+    if ids is None or len(corners) == 0:
+        return scene, use_index
+    slots = np.fromiter((id_to_slot.get(i, -1) for i in ids.ravel()), dtype=int, count=len(ids))
+    valid = slots >= 0
+    scene.reshape(-1, 4, 2)[slots[valid]] = np.asarray(corners, dtype=np.float32).reshape(-1, 4, 2)[valid]
+    use_index.reshape(-1, 4)[slots[valid]] = True
     return scene, use_index
 
 
+# Computes R.T @ (point - tvec); R is orthonormal, so its inverse is its transpose
+if have_numba:
+    # Unrolled so numba compiles it without a BLAS call on the transposed (non-contiguous) R
+    @njit(cache=True)
+    def _reverse_project(point, R, tvec):
+        out = np.empty((3, 1))
+        for i in range(3):
+            out[i, 0] = (R[0, i] * (point[0, 0] - tvec[0, 0]) + R[1, i] * (point[1, 0] - tvec[1, 0]) +
+                         R[2, i] * (point[2, 0] - tvec[2, 0]))
+        return out
+else:
+    def _reverse_project(point, R, tvec):
+        return R.T @ (point - tvec)
+
+
 # Function to reverse the projection of a point given a rvec and tvec
 def reverse_project(point, rvec, tvec):
-    poi = np.matrix(point)
     R, _ = cv.Rodrigues(rvec)
-    R_mat = np.matrix(R)
-    R_inv = np.linalg.inv(R_mat)
-    T = np.matrix(tvec)
-    return np.array(R_inv * (poi - T))
+    return _reverse_project(np.ascontiguousarray(point, dtype=np.float64).reshape(3, 1), R,
+                            np.ascontiguousarray(tvec, dtype=np.float64).reshape(3, 1))
 
 
 # Function to create 3D points from 2D pixels on a sheet of paper
 def get_3d_points_from_pixels(obj_pts, pixels_per_cm):
-    pts_3d = np.empty((len(obj_pts), 3), dtype=np.float32)
-    for i in range(len(obj_pts)):
-        pts_3d[i, 0] = obj_pts[i, 0] / pixels_per_cm
-        pts_3d[i, 1] = obj_pts[i, 1] / pixels_per_cm
-        pts_3d[i, 2] = 0
+    pts_3d = np.zeros((len(obj_pts), 3), dtype=np.float32, order='C')
+    pts_3d[:, :2] = np.asarray(obj_pts)[:, :2] / pixels_per_cm
     return pts_3d
 
 
+# Runs solvePnP, starting from the previous pose when one is available
+def solve_pnp(obj_pts, scene_pts, intrinsic_matrix, distortion, rvec=None, tvec=None):
+    if rvec is None or tvec is None:
+        return cv.solvePnP(obj_pts, scene_pts, intrinsic_matrix, distortion)
+    return cv.solvePnP(obj_pts, scene_pts, intrinsic_matrix, distortion, rvec, tvec,
+                       useExtrinsicGuess=True, flags=cv.SOLVEPNP_ITERATIVE)
+
+
 # Draws the axes on the image
 def drawAxes(img, imgpts):
     imgpts = imgpts.astype(int)
@@ -53,15 +145,95 @@ def drawAxes(img, imgpts):
     return img
 
 
-# Retrieves the zone of the point of interest on the map
-def get_zone(point_of_interest, img_map, pixels_per_cm):
-    x = int(point_of_interest[0] * pixels_per_cm)
-    y = int(point_of_interest[1] * pixels_per_cm)
+# End points of the axes drawn on the map, followed by their origin
+axis = np.float32([[6, 0, 0], [0, 6, 0], [0, 0, -6], [0, 0, 0]]).reshape(-1, 3)
+
+
+# Draws the axes and circles on the backprojected corner points
+def annotate_image(img, obj_pts, rvec, tvec, intrinsic_matrix):
+    # Project the corner points and the axes together in a single call
+    all_pts, other = cv.projectPoints(np.vstack([obj_pts, axis]).astype(np.float32), rvec, tvec, intrinsic_matrix,
+                                      None)
+    backprojection_pts, axis_pts = all_pts[:len(obj_pts)], all_pts[len(obj_pts):]
+    img = drawAxes(img, axis_pts)
+
+    pts_int = np.rint(backprojection_pts).astype(np.int32).reshape(-1, 2)
+    for x, y in pts_int.tolist():
+        cv.circle(img, (x, y), 4, (255, 255, 255), 2)
+    # Mark the center of each point that lies inside the image
+    in_img = ((0 <= pts_int[:, 0]) & (pts_int[:, 0] < img.shape[1]) &
+              (0 <= pts_int[:, 1]) & (pts_int[:, 1] < img.shape[0]))
+    img[pts_int[in_img, 1], pts_int[in_img, 0]] = (255, 0, 0)
+    return img
+
+
+@njit(cache=True)
+def _get_zone(px, py, img_map, pixels_per_cm):
+    x = int(px * pixels_per_cm)
+    y = int(py * pixels_per_cm)
     if 0 <= x < img_map.shape[1] and 0 <= y < img_map.shape[0]:
-        return img_map[y, x]
+        return int(img_map[y, x])
     else:
         return 0
 
+
+# Retrieves the zone of the point of interest on the map
+def get_zone(point_of_interest, img_map, pixels_per_cm):
+    return _get_zone(float(point_of_interest[0, 0]), float(point_of_interest[1, 0]), img_map, float(pixels_per_cm))
+
+
+# Returns the most frequent zone in the filter buffer, preferring the lowest zone index on ties
+@njit(cache=True)
+def _ring_mode(buf):
+    return np.argmax(np.bincount(buf))
+
+
+# Compile the jitted helpers at startup rather than on the first frame
+_reverse_project(np.zeros((3, 1)), np.eye(3), np.zeros((3, 1)))
+_get_zone(0.0, 0.0, np.zeros((1, 1), dtype=np.uint8), 1.0)
+_ring_mode(np.zeros(1, dtype=int))
+
+
+# Maps marker corners detected on a downscaled image back to full resolution, keeping pixel centres aligned
+def rescale_corners(corners, scale):
+    if scale == 1.0:
+        return corners
+    return tuple((c + 0.5) / scale - 0.5 for c in corners)
+
+
+# Picks the detection scale for the next frame from scales (largest first), so the smallest marker stays at least
+# target_px pixels wide. It only steps down once the marker would stay well above target_px at the smaller scale,
+# so the scale does not flip back and forth between frames.
+def update_detect_scale(scale, corners, target_px, scales):
+    if len(corners) == 0:
+        return scales[0]
+    side = min(np.linalg.norm(np.diff(c[0], axis=0, append=c[0][:1]), axis=1).mean() for c in corners)
+    i = scales.index(scale)
+    if i > 0 and side * scale < target_px:
+        return scales[i - 1]
+    if i + 1 < len(scales) and side * scales[i + 1] >= 1.25 * target_px:
+        return scales[i + 1]
+    return scale
+
+
+# Argparse type for options that must be at least 1
+def positive_int(value):
+    ivalue = int(value)
+    if ivalue < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return ivalue
+
+
+# Returns the camera ports that can be opened and return an image
+def list_ports(max_ports=6):
+    working_ports = []
+    for port in range(max_ports):
+        cap = cv.VideoCapture(port)
+        if cap.isOpened() and cap.read()[0]:
+            working_ports.append(port)
+        cap.release()
+    return working_ports
+
 #========================================
 pixels_per_cm_obj = 118.49  # text-with-aruco.png
 focal_length_x = 1.88842395e+03
@@ -70,152 +242,243 @@ camera_center_x = 9.21949329e+02
 camera_center_y = 3.34464319e+02
 distortion = np.array([0.09353041, -0.12232207, 0.00182885, -0.00131933, -0.30184632], dtype=np.float32) * 0
 use_external_cam = 0
+camera_warmup_frames = 10
+detect_scales = (1.0, 0.5, 0.25)  # scales of the image used for aruco detection, largest first
+detect_scale = 0.5  # initial scale, one of detect_scales
+detect_target_marker_px = 40  # desired side length of the smallest map marker in the detection image
+map_redetect_interval = 30  # frames after which the map pose is always re-detected
+map_motion_threshold = 4.0  # mean gray level difference above which the map pose is re-detected
 #========================================
 
-parser = argparse.ArgumentParser(description='Code for CamIO.')
-parser.add_argument('--input1', help='Path to input zone image.', default='zone_map.png')
-args = parser.parse_args()
-
-if os.path.isfile('camera_parameters.pkl'):
-    with open('camera_parameters.pkl', 'rb') as f:
-        focal_length_x, focal_length_y, camera_center_x, camera_center_y = pickle.load(f)
-        print("loaded camera parameters from file.")
-
-intrinsic_matrix = np.array([[focal_length_x, 0.00000000e+00, camera_center_x],
-                             [0.00000000e+00, focal_length_y, camera_center_y],
-                             [0.00000000e+00, 0.00000000e+00, 1.00000000e+00]], dtype=np.float32)
-# intrinsic_matrix = np.transpose(np.array([[1469.8549, 0.0, 0.0], [0.0, 1469.8549, 0.0], [964.5927, 718.271, 1.0]], dtype=np.float32))
-
-# Zone filter logic
-prev_zone_name = None
-zone_filter_size = 10
-zone_filter = np.zeros(zone_filter_size, dtype=int)
-zone_filter_cnt = 0
-
-# Load color image
-img_map_color = cv.imread(args.input1, cv.IMREAD_COLOR)  # Image.open(cv.samples.findFile(args.input1))
-img_map = cv.cvtColor(img_map_color, cv.COLOR_BGR2GRAY)
-
-scene = np.empty((16, 2), dtype=np.float32)
-player = pyglet.media.Player()
-cap = cv.VideoCapture(use_external_cam)
-start_time = time.time()
-cap.set(cv.CAP_PROP_FRAME_HEIGHT,1080) #set camera image height
-cap.set(cv.CAP_PROP_FRAME_WIDTH,1920) #set camera image width
-cap.set(cv.CAP_PROP_FOCUS,0)
-
-# Main loop
-while cap.isOpened():
-    ret, frame = cap.read()
-    if not ret:
-        print("No camera image returned.")
-        break
-
-    img_scene_color = frame
-
-    # load images grayscale
-    img_scene = cv.cvtColor(img_scene_color, cv.COLOR_BGR2GRAY)
-
-    # Define aruco marker dictionary and parameters object to include subpixel resolution
-    aruco_dict = cv.aruco.Dictionary_get(cv.aruco.DICT_4X4_50)
+
+def main():
+    parser = argparse.ArgumentParser(description='Code for CamIO.')
+    parser.add_argument('--input1', help='Path to input zone image.', default='zone_map.png')
+    parser.add_argument('--map-dict', help='Aruco dictionary of the map markers.', default='DICT_4X4_50',
+                        choices=aruco_dict_ids)
+    parser.add_argument('--pointer-dict', help='Aruco dictionary of the pointer marker.', default='DICT_5X5_50',
+                        choices=aruco_dict_ids)
+    parser.add_argument('--display', action='store_true', help='Show the annotated camera image.')
+    parser.add_argument('--display-every', type=positive_int, default=3,
+                        help='Show only every Nth frame when displaying.')
+    parser.add_argument('--list-ports', action='store_true', help='List the camera ports that return images and exit.')
+    args = parser.parse_args()
+
+    if args.list_ports:
+        print(list_ports())
+        return
+
+    fx, fy, cx, cy = focal_length_x, focal_length_y, camera_center_x, camera_center_y
+    if os.path.isfile('camera_parameters.pkl'):
+        with open('camera_parameters.pkl', 'rb') as f:
+            fx, fy, cx, cy = pickle.load(f)
+            print("loaded camera parameters from file.")
+
+    intrinsic_matrix = np.array([[fx, 0.00000000e+00, cx],
+                                 [0.00000000e+00, fy, cy],
+                                 [0.00000000e+00, 0.00000000e+00, 1.00000000e+00]], dtype=np.float32)
+    # intrinsic_matrix = np.transpose(np.array([[1469.8549, 0.0, 0.0], [0.0, 1469.8549, 0.0], [964.5927, 718.271, 1.0]], dtype=np.float32))
+
+    # Zone filter logic
+    prev_zone_name = None
+    zone_filter_size = 10
+    zone_filter = np.zeros(zone_filter_size, dtype=int)
+    zone_filter_cnt = 0
+    # Zone index -> (zone name, sound file), so each frame needs a single lookup
+    zone_table = {zone: (name, './MP3/' + sound_dict_ukraine[zone]) for zone, name in map_dict_ukraine.items()}
+
+    # Load color image and convert it once to a zone index image, with 0 wherever the gray value is not a zone
+    img_map_color = cv.imread(args.input1, cv.IMREAD_COLOR)  # Image.open(cv.samples.findFile(args.input1))
+    zone_lut = np.zeros(256, dtype=np.uint8)
+    zone_lut[list(zone_table)] = list(zone_table)
+    img_map = zone_lut[cv.cvtColor(img_map_color, cv.COLOR_BGR2GRAY)]
+    del img_map_color
+
+    # Define aruco marker dictionaries and a parameters object, shared by the map and pointer, to include subpixel
+    # resolution. The map (4x4) and pointer (5x5) use different marker sizes by default, so they are detected in
+    # separate passes.
+    map_aruco_dict = cv.aruco.Dictionary_get(get_aruco_dict_id_from_string(args.map_dict))
+    pointer_aruco_dict = cv.aruco.Dictionary_get(get_aruco_dict_id_from_string(args.pointer_dict))
     arucoParams = cv.aruco.DetectorParameters_create()
     arucoParams.cornerRefinementMethod = cv.aruco.CORNER_REFINE_SUBPIX
-    # Detect aruco markers in image
-    (corners, ids, rejected) = cv.aruco.detectMarkers(img_scene, aruco_dict, parameters=arucoParams)
-    scene, use_index = sort_corners_by_id(corners, id, scene)
-
-    if ids is None or not any(use_index):
-        print("No markers found.")
-        cv.imshow('image reprojection', img_scene_color)
-        waitkey = cv.waitKey(1)
-        if waitkey == 27:
-            print('Escape.')
-            cap.release()
-            cv.destroyAllWindows()
-            break
-        continue
-
-    # Run solvePnP using the markers that have been observed
-    retval, rvec, tvec = cv.solvePnP(obj[use_index, :], scene[use_index, :], intrinsic_matrix, None)
-
-    # Draw axes on the image
-    axis = np.float32([[6, 0, 0], [0, 6, 0], [0, 0, -6], [0, 0, 0]]).reshape(-1, 3)
-    axis_pts, other = cv.projectPoints(axis, rvec, tvec, intrinsic_matrix, None)
-    img_scene_color = drawAxes(img_scene_color, axis_pts)
-
-    # Draw circles on the backprojected corner points
-    backprojection_pts, other = cv.projectPoints(obj, rvec, tvec, intrinsic_matrix, None)
-    for idx, pts in enumerate(backprojection_pts):
-        cv.circle(img_scene_color, (int(pts[0, 0]), int(pts[0, 1])), 4, (255, 255, 255), 2)
-        cv.line(img_scene_color, (int(pts[0, 0] - 1), int(pts[0, 1])), (int(pts[0, 0]) + 1, int(pts[0, 1])),
-                (255, 0, 0), 1)
-        cv.line(img_scene_color, (int(pts[0, 0]), int(pts[0, 1]) - 1), (int(pts[0, 0]), int(pts[0, 1]) + 1),
-                (255, 0, 0), 1)
-        # cv.line(img_scene_color, (int(pts[0,0]), int(pts[0,1])), (int(scene[idx,0]), int(scene[idx,1])), (0, 255, 0), 1)
-
-    # Set up aruco detection for the pointer marker
-    aruco_dict = cv.aruco.Dictionary_get(cv.aruco.DICT_5X5_50)
-    dp = cv.aruco.DetectorParameters_create()
-    dp.cornerRefinementMethod = cv.aruco.CORNER_REFINE_SUBPIX
-
-    corners, ids, _ = cv.aruco.detectMarkers(img_scene, aruco_dict, parameters=dp)
-    obj_aruco = np.empty((4, 3), dtype=np.float32)
-    scene_aruco = np.empty((4, 2), dtype=np.float32)
-
-    # if we are just using 1 large marker
-    obj_aruco[0, :] = [0.5, 0.5, 0]
-    obj_aruco[1, :] = [3.5, 0.5, 0]
-    obj_aruco[2, :] = [3.5, 3.5, 0]
-    obj_aruco[3, :] = [0.5, 3.5, 0]
-
-    if len(corners) > 0:
-        for i in range(4):
-            scene_aruco[i, :] = corners[0][0][i]
-            cv.circle(img_scene_color, (int(scene_aruco[i, 0]), int(scene_aruco[i, 1])), 3, (255, 255, 255), 2)
-
-    retval, rvec_aruco, tvec_aruco = cv.solvePnP(obj_aruco, scene_aruco, intrinsic_matrix, distortion)
-    # Backproject pointer tip and draw it on the image
-    backprojection_pt, other = cv.projectPoints(np.array([0, 0, 0], dtype=np.float32).reshape(1, 3), rvec_aruco,
-                                                tvec_aruco, intrinsic_matrix, distortion)
-    if len(corners) > 0:
-        cv.circle(img_scene_color, (int(backprojection_pt[0, 0, 0]), int(backprojection_pt[0, 0, 1])), 2, (0, 255, 0), 2)
-
-    # Get pointer location in coordinates of the aruco markers
-    point_of_interest = reverse_project(tvec_aruco, rvec, tvec)
-
-    # Filter the zones by returning the mode of the last [zone_filter_size] zones
-    zone_filter[zone_filter_cnt] = get_zone(point_of_interest, img_map, pixels_per_cm_obj)
-    zone_filter_cnt = (zone_filter_cnt + 1) % zone_filter_size
-    zone = stats.mode(zone_filter).mode[0]
-
-    # Check if the Z position is within the threshold, if so, play a sound
-    Z_threshold_cm = 2.0
-    if np.abs(point_of_interest[2]) < Z_threshold_cm:
-        zone_name = map_dict_ukraine.get(zone, None)
-        if zone_name:
-            if prev_zone_name != zone_name:
-                soundfile = './MP3/' + sound_dict_ukraine.get(zone, None)
-                if os.path.exists(soundfile) and time.time() - start_time > 0.5:
-                    sound = pyglet.media.load(soundfile, streaming=False)
-                    # player.next_source()
-                    # player.queue(sound)
-                    # player.play()
-                    sound.play()
-                    start_time = time.time()
-                    #playsound(soundfile, block=False)
-            prev_zone_name = zone_name
-            print(zone_name)
-        else:
-            prev_zone_name = None
-    # print(point_of_interest)#, dist, current_region)
-
-    now = datetime.datetime.now()
-    cv.imshow('image reprojection', img_scene_color)
-    waitkey = cv.waitKey(1)
-    if waitkey == ord('s'):
-        cv.imwrite(f'{now.strftime("%Y.%m.%d.%H.%M.%S")}_backproject.jpg', img_scene_color)
-    if waitkey == 27:#Escape key
-        print('Escape.')
+    arucoParams.cornerRefinementMaxIterations = 10
+
+    # Buffers filled in place by sort_corners_by_id on every detection
+    scene = np.empty((16, 2), dtype=np.float32)
+    use_index = np.zeros(len(scene), dtype=bool)
+    map_id_to_slot = {marker_id: i for i, marker_id in enumerate(map_marker_ids)}
+    # Pointer marker corners in cm (if we are just using 1 large marker), centered on the marker in the order
+    # SOLVEPNP_IPPE_SQUARE requires: top-left, top-right, bottom-right, bottom-left with y pointing up
+    obj_aruco = np.array([[-1.5, 1.5, 0], [1.5, 1.5, 0], [1.5, -1.5, 0], [-1.5, -1.5, 0]], dtype=np.float32)
+    # Pointer tip in the same coordinates, 0.5cm to the left of and above the top-left corner of the marker
+    pointer_tip = np.array([[-2, 2, 0]], dtype=np.float32)
+    # Last solved map pose, used as the initial guess for solvePnP on the next frame
+    rvec, tvec = None, None
+    player = pyglet.media.Player()
+    sound_cache = {}
+    cap = cv.VideoCapture(use_external_cam)
+    start_time = time.time()
+    cap.set(cv.CAP_PROP_FOURCC, cv.VideoWriter_fourcc(*'MJPG'))  # compressed frames need far less USB bandwidth
+    cap.set(cv.CAP_PROP_FRAME_HEIGHT,1080) #set camera image height
+    cap.set(cv.CAP_PROP_FRAME_WIDTH,1920) #set camera image width
+    cap.set(cv.CAP_PROP_FPS, 30)
+    cap.set(cv.CAP_PROP_FOCUS,0)
+    cap.set(cv.CAP_PROP_BUFFERSIZE, 1)  # keep the driver queue short so frames are fresh
+    # Discard the first frames while auto-exposure settles
+    for _ in range(camera_warmup_frames):
+        cap.grab()
+    # Capture runs on a background thread; imshow/pollKey stay on the main thread as HighGUI requires
+    grabber = FrameGrabber(cap)
+
+    # Frame buffers reused across iterations; OpenCV reallocates them only if the size changes
+    frame, img_scene, img_detect_buf, motion_thumb = None, None, None, None
+    # Thumbnail of the frame the map pose was last detected on, and frames processed since then
+    map_ref_thumb = None
+    frames_since_map_detect = 0
+    frame_idx = 0
+    save_requested = False
+    next_detect_scale = detect_scale
+
+    # Main loop
+    try:
+        while cap.isOpened():
+            ret, frame = grabber.read(frame)
+            if not ret:
+                print("No camera image returned.")
+                break
+            # Annotating and showing the image is debug output, so it is skipped on frames that are not displayed
+            show_frame = args.display and frame_idx % args.display_every == 0
+            frame_idx += 1
+
+            img_scene_color = frame
+
+            # load images grayscale
+            img_scene = cv.cvtColor(img_scene_color, cv.COLOR_BGR2GRAY, dst=img_scene)
+
+            # downscale once for aruco detection, shared by the map and pointer detectors
+            img_detect_scale = next_detect_scale
+            if img_detect_scale < 1.0:
+                img_detect_buf = cv.resize(img_scene, None, dst=img_detect_buf, fx=img_detect_scale,
+                                           fy=img_detect_scale, interpolation=cv.INTER_AREA)
+                img_detect = img_detect_buf
+            else:
+                img_detect = img_scene
+
+            # The map is static, so reuse its last pose while the scene looks unchanged since it was last detected
+            motion_thumb = cv.resize(img_scene, (img_scene.shape[1] // 16, img_scene.shape[0] // 16), dst=motion_thumb,
+                                     interpolation=cv.INTER_AREA)
+            map_pose_cached = (rvec is not None and frames_since_map_detect < map_redetect_interval and
+                               cv.norm(motion_thumb, map_ref_thumb, cv.NORM_L1) / motion_thumb.size <
+                               map_motion_threshold)
+
+            if map_pose_cached:
+                frames_since_map_detect += 1
+            else:
+                # Detect aruco markers in image
+                (corners, ids, rejected) = cv.aruco.detectMarkers(img_detect, map_aruco_dict, parameters=arucoParams)
+                corners = rescale_corners(corners, img_detect_scale)
+                scene, use_index = sort_corners_by_id(corners, ids, scene, map_id_to_slot, use_index)
+                next_detect_scale = update_detect_scale(img_detect_scale, corners, detect_target_marker_px,
+                                                        detect_scales)
+
+                if ids is None or not any(use_index):
+                    print("No markers found.")
+                    # The map may have moved while it was not visible, so the next solve starts without a guess
+                    rvec, tvec = None, None
+                    if show_frame:
+                        cv.imshow('image reprojection', img_scene_color)
+                    waitkey = cv.pollKey() if args.display else -1
+                    if waitkey == 27:
+                        print('Escape.')
+                        break
+                    continue
+
+                # Run solvePnP using the markers that have been observed
+                retval, rvec, tvec = solve_pnp(obj[use_index, :], scene[use_index, :], intrinsic_matrix, None,
+                                               rvec, tvec)
+                map_ref_thumb = motion_thumb.copy()
+                frames_since_map_detect = 0
+
+            # Draw axes and backprojected corner points on the image
+            if show_frame:
+                img_scene_color = annotate_image(img_scene_color, obj, rvec, tvec, intrinsic_matrix)
+
+            # Detect the pointer marker
+            corners, ids, _ = cv.aruco.detectMarkers(img_detect, pointer_aruco_dict, parameters=arucoParams)
+            corners = rescale_corners(corners, img_detect_scale)
+
+            # Only track the pointer on frames where its marker is visible
+            if len(corners) > 0:
+                scene_aruco = corners[0][0]
+                if show_frame:
+                    for i in range(4):
+                        cv.circle(img_scene_color, (int(scene_aruco[i, 0]), int(scene_aruco[i, 1])), 3,
+                                  (255, 255, 255), 2)
+
+                # The pointer is a single square marker, which IPPE_SQUARE solves in closed form
+                retval, rvec_aruco, tvec_aruco = cv.solvePnP(obj_aruco, scene_aruco, intrinsic_matrix, distortion,
+                                                             flags=cv.SOLVEPNP_IPPE_SQUARE)
+                # Backproject pointer tip and draw it on the image
+                if show_frame:
+                    backprojection_pt, other = cv.projectPoints(pointer_tip, rvec_aruco, tvec_aruco, intrinsic_matrix,
+                                                                distortion)
+                    cv.circle(img_scene_color, (int(backprojection_pt[0, 0, 0]), int(backprojection_pt[0, 0, 1])), 2,
+                              (0, 255, 0), 2)
+
+                # Get pointer location in coordinates of the aruco markers
+                R_aruco, _ = cv.Rodrigues(rvec_aruco)
+                point_of_interest = reverse_project(R_aruco @ pointer_tip.reshape(3, 1) + tvec_aruco, rvec, tvec)
+
+                # Filter the zones by returning the mode of the last [zone_filter_size] zones
+                zone_filter[zone_filter_cnt] = get_zone(point_of_interest, img_map, pixels_per_cm_obj)
+                zone_filter_cnt = (zone_filter_cnt + 1) % zone_filter_size
+                zone = int(_ring_mode(zone_filter))
+
+                # Check if the Z position is within the threshold, if so, play a sound
+                Z_threshold_cm = 2.0
+                if np.abs(point_of_interest[2]) < Z_threshold_cm:
+                    zone_name, soundfile = zone_table.get(zone, (None, None))
+                    if zone_name:
+                        if prev_zone_name != zone_name:
+                            if os.path.exists(soundfile) and time.time() - start_time > 0.5:
+                                # Decode each sound the first time its zone is reached and keep it for later visits
+                                sound = sound_cache.get(zone)
+                                if sound is None:
+                                    sound = pyglet.media.load(soundfile, streaming=False)
+                                    sound_cache[zone] = sound
+                                # player.next_source()
+                                # player.queue(sound)
+                                # player.play()
+                                sound.play()
+                                start_time = time.time()
+                                #playsound(soundfile, block=False)
+                        prev_zone_name = zone_name
+                        print(zone_name)
+                    else:
+                        prev_zone_name = None
+            # print(point_of_interest)#, dist, current_region)
+
+            now = datetime.datetime.now()
+            if show_frame:
+                cv.imshow('image reprojection', img_scene_color)
+            # Poll without blocking so key presses are still handled on frames that are not shown
+            waitkey = cv.pollKey() if args.display else -1
+            # Only annotated, shown frames are saved, so a request made between them waits for the next shown frame
+            if waitkey == ord('s'):
+                save_requested = True
+            if save_requested and show_frame:
+                cv.imwrite(f'{now.strftime("%Y.%m.%d.%H.%M.%S")}_backproject.jpg', img_scene_color)
+                save_requested = False
+            if waitkey == 27:#Escape key
+                print('Escape.')
+                break
+    except KeyboardInterrupt:
+        print('Interrupted.')
+    finally:
+        grabber.stop()
         cap.release()
         cv.destroyAllWindows()
-        break
\ No newline at end of file
+
+
+if __name__ == '__main__':
+    main()